@@ -1,90 +1,277 @@
-#!/usr/bin/python
+#!/usr/bin/env python3
 
+import concurrent.futures
+import http.client
 import io
+import json
 import os
 import re
+import shutil
 import sys
+import tempfile
+import threading
+import urllib.parse
 import zipfile
 
-try:
-    import urllib.request
-except ImportError:
-    import urllib2
-    urlopen = urllib2.urlopen
-else:
-    urlopen = urllib.request.urlopen
-
-
 URL="http://smisioto.no-ip.org/elettronica/kicad/kicad-en.htm"
 URLBASE="http://smisioto.no-ip.org"
 OUTDIR="3d"
+SPOOL_SIZE=8*1024*1024  # archives larger than this are spooled to disk
+CHUNK_SIZE=64*1024
+WORKERS=8
+MAX_REDIRECTS=5
+PACKAGE_HREF='href="/kicad_libs/packages3d/'
+MODEL_EXTS=(".wrl", ".wings")
+LICENSE_NAME="walter/license.txt"
+CACHE_FILE=os.path.join (OUTDIR, "cache.json")
 
-def print_no_newline (s):
-    """Print s without a newline. Cross Python2/3 compatible."""
-    sys.stdout.write (s)
-    sys.stdout.flush ()
-
-def copyfile (dest, src):
-    while True:
-        block = src.read (1024)
-        dest.write (block)
-        if len (block) < 1024:
-            break
-
-def makepath (path):
-    path_components = path.split ('/')
-    incremental_paths = [path_components[:i] for i in range (1, len (path_components))]
-    for i in incremental_paths:
-        i = os.path.join (*i)
-        if not os.path.isdir (i):
-            os.mkdir (i)
+log_lock = threading.Lock ()
 
-# First, download the index page and extract the list of packages
-packages = []
-f = urlopen (URL)
-for line in f:
-    line = line.decode ("utf8").strip ()
-    if 'href="/kicad_libs/packages3d/' not in line:
-        continue
-    package_url_match = re.match (r'<A href="([^"]+)"', line)
-    packages.append (URLBASE + package_url_match.group (1))
-f.close ()
+def log (s):
+    """Print a whole line at once, so lines from different workers don't
+    interleave."""
+    with log_lock:
+        print (s, flush=True)
 
-# Now, grab each one
-extracted_license = False   # only extract the license once
-for url in packages:
+connections = threading.local ()
 
+def get_connection (scheme, netloc):
+    """Return this thread's kept-alive connection to the given host, creating
+    it on first use."""
+    try:
+        conns = connections.conns
+    except AttributeError:
+        conns = connections.conns = {}
+    conn = conns.get ((scheme, netloc))
+    if conn is None:
+        if scheme == "https":
+            conn = http.client.HTTPSConnection (netloc)
+        else:
+            conn = http.client.HTTPConnection (netloc)
+        conns[(scheme, netloc)] = conn
+    return conn
+
+def urlopen (url, headers=None, redirects=MAX_REDIRECTS):
+    """GET url over a reused connection, following redirects. The response
+    must be read to the end before this thread makes another request. A 304
+    is returned like a 200, for callers that sent conditional headers."""
+    if headers is None:
+        headers = {}
+    parts = urllib.parse.urlsplit (url)
+    path = parts.path or "/"
+    if parts.query:
+        path += "?" + parts.query
+    conn = get_connection (parts.scheme, parts.netloc)
+    try:
+        conn.request ("GET", path, headers=headers)
+        resp = conn.getresponse ()
+    except ConnectionError:
+        # The server dropped the idle connection; retry once on a fresh one
+        conn.close ()
+        conn.request ("GET", path, headers=headers)
+        resp = conn.getresponse ()
+
+    if resp.status in (301, 302, 303, 307, 308) and redirects:
+        resp.read ()
+        location = urllib.parse.urljoin (url, resp.getheader ("Location"))
+        return urlopen (location, headers, redirects - 1)
+    elif resp.status not in (200, 304):
+        resp.read ()
+        raise Exception ("%s: HTTP %d %s" % (url, resp.status, resp.reason))
+    return resp
+
+made_dirs = set ()
+made_dirs_lock = threading.Lock ()
+
+def makedirs_for (path):
+    """Create the directory that will hold path. Directories are remembered,
+    so each one costs a syscall only the first time."""
+    d = os.path.dirname (path)
+    if d and d not in made_dirs:
+        os.makedirs (d, exist_ok=True)
+        with made_dirs_lock:
+            made_dirs.add (d)
+
+def package_name (url):
     name_m = re.search (r'(3d_.+.zip)', url)
     if name_m is None:
-        name = url
+        return url
     else:
-        name = name_m.group (1)
-    print_no_newline ("Downloading %s..." % name)
-    sys.stdout.flush ()
+        return name_m.group (1)
+
+def take_license ():
+    """Return True exactly once, for the first package to ask."""
+    global extracted_license
+    with license_lock:
+        if extracted_license:
+            return False
+        extracted_license = True
+        return True
+
+def load_cache ():
+    """Load the manifest of previously extracted packages, mapping each URL
+    to its ETag, Last-Modified date and extracted files. Returns None if
+    there is no readable manifest."""
+    try:
+        with open (CACHE_FILE) as f:
+            return json.load (f)
+    except (OSError, ValueError):
+        return None
+
+def clear_models ():
+    """Delete the model directories under OUTDIR."""
+    if not os.path.isdir (OUTDIR):
+        return
+    for name in os.listdir (OUTDIR):
+        path = os.path.join (OUTDIR, name)
+        if os.path.isdir (path):
+            shutil.rmtree (path)
 
-    f = urlopen (url)
-    data = f.read ()
+def save_cache (cache):
+    os.makedirs (OUTDIR, exist_ok=True)
+    tmpfn = CACHE_FILE + ".tmp"
+    with open (tmpfn, 'w') as f:
+        json.dump (cache, f, indent=1, sort_keys=True)
+    os.replace (tmpfn, CACHE_FILE)
+
+def remove_stale (cache, new_cache):
+    """Delete files extracted by an earlier run that no package provides any
+    more, because its archive changed or it was dropped from the index."""
+    keep = set ()
+    for entry in new_cache.values ():
+        keep.update (entry["files"])
+    for entry in cache.values ():
+        for name in entry["files"]:
+            if name in keep:
+                continue
+            path = os.path.join (OUTDIR, name)
+            try:
+                os.remove (path)
+            except FileNotFoundError:
+                continue
+            log ("Removed %s" % name)
+            # Prune directories left empty; stops at the first non-empty one
+            try:
+                os.removedirs (os.path.dirname (path))
+            except OSError:
+                pass
+
+def download_and_extract (url, entry):
+    """Download one package and extract its models, unless the server says
+    it hasn't changed since the cache entry was made. Returns the new cache
+    entry. Called from worker threads."""
+
+    # Only ask for a conditional download if everything we extracted last
+    # time is still there
+    headers = {}
+    if entry is not None and all (os.path.exists (os.path.join (OUTDIR, i))
+            for i in entry["files"]):
+        if entry.get ("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get ("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+
+    f = urlopen (url, headers)
+    if f.status == 304:
+        f.read ()
+        f.close ()
+        log ("Unchanged %s" % package_name (url))
+        return entry
+    new_entry = {
+        "etag": f.getheader ("ETag"),
+        "last_modified": f.getheader ("Last-Modified"),
+        "files": [],
+    }
+
+    # Stream the archive into a spooled file rather than reading it whole;
+    # ZipFile only needs to seek to the central directory at the end.
+    # An archive already known to be too big goes straight to disk, rather
+    # than filling the in-memory buffer first and then being copied over.
+    virtfile = tempfile.SpooledTemporaryFile (max_size=SPOOL_SIZE)
+    length = f.getheader ("Content-Length", "")
+    if length.isdigit () and int (length) > SPOOL_SIZE:
+        virtfile.rollover ()
+    shutil.copyfileobj (f, virtfile, CHUNK_SIZE)
     f.close ()
+    virtfile.seek (0)
+
+    # Before Python 3.11 SpooledTemporaryFile has no seekable (), which
+    # ZipFile needs to open members, so give it the file underneath
+    if sys.version_info < (3, 11):
+        zf = zipfile.ZipFile (virtfile._file)
+    else:
+        zf = zipfile.ZipFile (virtfile)
+
+    # Extract the models without their "walter/" prefix. ZipFile reads members
+    # by their original name, so renaming the ZipInfo only changes where
+    # extract() writes the file. Directories are made up front because
+    # extract() is not safe against other workers making the same ones.
+    models = []
+    license_info = None
+    for info in zf.infolist ():
+        if info.filename == LICENSE_NAME:
+            license_info = info
+        elif info.filename.endswith (MODEL_EXTS):
+            info.filename = info.filename.replace ("walter/", "")
+            makedirs_for (os.path.join (OUTDIR, info.filename))
+            models.append (info)
 
-    virtfile = io.BytesIO (data)
-    zf = zipfile.ZipFile (virtfile)
-
-    # Manually extract, as we change the paths a bit
-    count = 0
-    for filename in zf.namelist ():
-        if filename == "walter/license.txt" and not extracted_license:
-            extracted_license = True
-            destfn = os.path.join (OUTDIR, "license.txt")
-            makepath (destfn)
-            with zf.open (filename) as fsrc, open (destfn, 'wb') as fdest:
-                copyfile (fdest, fsrc)
-        elif filename.endswith (".wrl") or filename.endswith (".wings"):
-            count += 1
-            destfn = os.path.join (OUTDIR, filename.replace ("walter/", ""))
-            makepath (destfn)
-            with zf.open (filename) as fsrc, open (destfn, 'wb') as fdest:
-                copyfile (fdest, fsrc)
+    # Each member is an independent deflate stream, and zlib releases the GIL,
+    # so decompress them in parallel. ZipFile serializes the reads from the
+    # shared archive file itself.
+    jobs = [extract_pool.submit (zf.extract, info, OUTDIR) for info in models]
+    for job in jobs:
+        job.result ()
+
+    # Only one package extracts the license, but every package that has it
+    # lists it, so it isn't pruned while any of them is still around
+    if license_info is not None:
+        if take_license ():
+            license_info.filename = "license.txt"
+            zf.extract (license_info, OUTDIR)
+        new_entry["files"].append ("license.txt")
 
     zf.close ()
+    virtfile.close ()
+    new_entry["files"].extend (info.filename for info in models)
+    log ("Downloaded %s: %d models" % (package_name (url), len (models)))
+    return new_entry
+
+# First, download the index page and extract the list of packages
+packages = []
+f = io.TextIOWrapper (urlopen (URL), encoding="utf8", newline="")
+for line in f:
+    start = line.find (PACKAGE_HREF)
+    if start < 0:
+        continue
+    start += len ('href="')
+    end = line.index ('"', start)
+    packages.append (URLBASE + line[start:end])
+f.close ()
 
-    print ("%d models" % count)
+# Now, grab each one that has changed since the last run. The downloads are
+# latency-bound, so run several at once, reporting each package as it
+# finishes. A zip can't be extracted until its central directory (at the
+# end) has arrived, but while one worker extracts, the others keep
+# downloading, so the two stages overlap. At most WORKERS archives are held
+# at a time, each in RAM only up to SPOOL_SIZE.
+extracted_license = False   # only extract the license once
+license_lock = threading.Lock ()
+cache = load_cache ()
+if cache is None:
+    # Without a manifest, nothing already in OUTDIR could ever be pruned (it
+    # may predate the manifest), so clear the models out once
+    clear_models ()
+    cache = {}
+new_cache = {}
+extract_pool = concurrent.futures.ThreadPoolExecutor (max_workers=os.cpu_count ())
+with concurrent.futures.ThreadPoolExecutor (max_workers=WORKERS) as pool:
+    futures = [pool.submit (download_and_extract, url, cache.get (url))
+            for url in packages]
+    for url, future in zip (packages, futures):
+        new_cache[url] = future.result ()
+extract_pool.shutdown ()
+# Prune only once every package is done, as a file (the license, say) may
+# move from one package to another between runs
+remove_stale (cache, new_cache)
+save_cache (new_cache)
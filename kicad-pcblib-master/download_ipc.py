@@ -1,4 +1,3 @@
-#!/usr/bin/env python
 #!/usr/bin/env python3
 
 # download_ipc
@@ -9,37 +8,26 @@
 # This script downloads the IPC libraries from FreePCB and converts them to
 # KiCad format using freepcb2kicad.
 
+import sys
+if sys.version_info < (3, 8):
+    sys.exit ("download_ipc requires Python 3.8 or newer.")
+
+import contextlib
 import zipfile
 import tempfile
 import shutil
-import imp
+import importlib.machinery
+import importlib.util
 import os
-import shutil
+from urllib.parse import urlsplit
+from urllib.request import urlopen
 
 VERSION = "1.0"
 
-FREEPCB2KICAD_ARGS = ["--blurb", "--rounded-pads", "--strip-lmn"]
-
-# Py2/3 imports
-try:
-    from urllib.request import urlopen
-except ImportError:
-    from urllib2 import urlopen
-
-try:
-    from io import BytesIO
-except ImportError:
-    from StringIO import StringIO as BytesIO
-
-try:
-    raw_input
-except NameError:
-    raw_input = input
+SPOOL_SIZE = 32 * 1024 * 1024   # larger downloads are spooled to disk
+CHUNK_SIZE = 64 * 1024
 
-try:
-    bytes
-except NameError:
-    bytes = str
+FREEPCB2KICAD_ARGS = ("--blurb", "--rounded-pads", "--strip-lmn")
 
 # Confirm the FreePCB license
 CONFIRMLICENSE_MSG="""\
@@ -55,13 +43,39 @@ class ConfirmLicense (object):
         if self.already_confirmed:
             return
         print (CONFIRMLICENSE_MSG)
-        acc = raw_input ("Do you accept the license? (y/n) ")
+        acc = input ("Do you accept the license? (y/n) ")
         if acc.lower () not in ("y", "yes"):
             raise LicenseException ("License not accepted.")
         self.already_confirmed = True
 confirm_license = ConfirmLicense ()
 
 
+def find_compiled (path):
+    """Return the path of a compiled extension built from the source file at
+    path (see 'make cython'), or None if there is none at least as new."""
+    base = os.path.splitext (path)[0]
+    for suffix in importlib.machinery.EXTENSION_SUFFIXES:
+        if os.path.exists (base + suffix) and \
+                os.path.getmtime (base + suffix) >= os.path.getmtime (path):
+            return base + suffix
+    return None
+
+def load_source (name, path):
+    """Import the Python source file at path as module 'name', or its
+    compiled extension if there is an up to date one."""
+    compiled = find_compiled (path)
+    if compiled is not None:
+        # An extension can only be imported under its own name
+        own_name = os.path.basename (os.path.splitext (path)[0])
+        spec = importlib.util.spec_from_file_location (own_name, compiled)
+        sys.modules[own_name] = module = importlib.util.module_from_spec (spec)
+    else:
+        spec = importlib.util.spec_from_file_location (name, path)
+        module = importlib.util.module_from_spec (spec)
+    sys.modules[name] = module
+    spec.loader.exec_module (module)
+    return module
+
 def main ():
     # Get args
     from argparse import ArgumentParser
@@ -106,86 +120,74 @@ def main ():
 
     args = p.parse_args ()
 
+    # Build the freepcb2kicad arguments locally, so main() can be called more
+    # than once without them piling up
+    fp_args = list (FREEPCB2KICAD_ARGS)
+
     if args.threedmap is not None:
-        FREEPCB2KICAD_ARGS.extend (["--3dmap", args.threedmap])
+        fp_args.extend (["--3dmap", args.threedmap])
 
     if args.rpexcept is not None:
-        FREEPCB2KICAD_ARGS.extend (["--rounded-pad-exceptions", args.rpexcept])
+        fp_args.extend (["--rounded-pad-exceptions", args.rpexcept])
 
     if args.rcexcept is not None:
-        FREEPCB2KICAD_ARGS.extend (["--rounded-center-exceptions", args.rcexcept])
+        fp_args.extend (["--rounded-center-exceptions", args.rcexcept])
 
     if args.courtyard is not None:
-        FREEPCB2KICAD_ARGS.extend (["--add-courtyard", args.courtyard])
+        fp_args.extend (["--add-courtyard", args.courtyard])
 
     if args.roundedpads == "all":
-        FREEPCB2KICAD_ARGS.append ("--rounded-pads")
+        fp_args.append ("--rounded-pads")
     elif args.roundedpads == "allbut1":
-        FREEPCB2KICAD_ARGS.append ("--rounded-except-1")
+        fp_args.append ("--rounded-except-1")
 
     if args.hashtime:
-        FREEPCB2KICAD_ARGS.append ("--hash-time")
+        fp_args.append ("--hash-time")
 
     # Download, if necessary, then open file
-    if args.src.startswith ("http:/"):
+    scheme = urlsplit (args.src).scheme
+    if scheme in ("http", "https"):
         if not args.no_confirm_license:
             confirm_license ()
         url = urlopen (args.src)
         print ("Downloading FreePCB library...")
+        ipc_f = tempfile.SpooledTemporaryFile (max_size=SPOOL_SIZE)
+        length = url.getheader ("Content-Length", "")
+        if length.isdigit () and int (length) > SPOOL_SIZE:
+            # Known to be too big for memory; skip the in-memory stage
+            ipc_f.rollover ()
         try:
-            data = url.read ()
-        except Exception as e:
-            url.close ()
+            with url:
+                shutil.copyfileobj (url, ipc_f, CHUNK_SIZE)
+        except BaseException:
+            ipc_f.close ()
             raise
-        else:
-            url.close ()
-        ipc_f = BytesIO (data) # data is bytes in Py3
+        ipc_f.seek (0)
+    elif "://" in args.src:
+        p.error ("unsupported URL scheme \"%s\"" % scheme)
     else:
         ipc_f = open (args.src, 'rb')
-    ipc_zip = zipfile.ZipFile (ipc_f)
 
-    # Create a temporary working directory, and extract the IPC files
-    # into it.
-    tempdir = tempfile.mkdtemp ()
+    # Create a temporary working directory for the conversion. It and the
+    # zip file are cleaned up however main_2 exits.
+    with contextlib.closing (ipc_f), tempfile.TemporaryDirectory () as tempdir:
+        # Before Python 3.11 SpooledTemporaryFile has no seekable (), which
+        # ZipFile needs to open members, so give it the file underneath
+        if isinstance (ipc_f, tempfile.SpooledTemporaryFile) and \
+                sys.version_info < (3, 11):
+            ipc_zip = zipfile.ZipFile (ipc_f._file)
+        else:
+            ipc_zip = zipfile.ZipFile (ipc_f)
+        main_2 (args, fp_args + [args.dest], tempdir, ipc_zip)
 
-    # Wrap the rest of the code in an exception catcher so we can clean up
-    # the files.
-    try:
-        main_2 (args, tempdir, ipc_zip)
-    except:
-        try:
-            ipc_f.close ()
-        except Exception as e:
-            print (e)
-        try:
-            shutil.rmtree (tempdir)
-        except Exception as e:
-            print (e)
-        raise
-    else:
-        exceptions = []
-        try:
-            ipc_f.close ()
-        except Exception as e:
-            exceptions.append (e)
-        try:
-            shutil.rmtree (tempdir)
-        except Exception as e:
-            exceptions.append (e)
-        for exc in exceptions:
-            print (exc)
-        if exceptions:
-            raise Exception ("Errors occurred.")
-
-def main_2 (args, tempdir, zipfile):
+def main_2 (args, fpargs, tempdir, zipfile):
     # If there is an exception, it will be caught and all working files will
     # be cleaned up.
 
     # Load freepcb2kicad
-    freepcb2kicad = imp.load_source ("freepcb2kicad", args.fp2kicad)
+    freepcb2kicad = load_source ("freepcb2kicad", args.fp2kicad)
 
     # Generate KiCad files
-    fpargs = FREEPCB2KICAD_ARGS + [args.dest]
     freepcb2kicad.main (fpargs, zipfile=zipfile)
 
 if __name__ == "__main__":
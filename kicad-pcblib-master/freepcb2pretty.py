@@ -1,4 +1,3 @@
-#!/usr/bin/env python
 #!/usr/bin/env python3
 
 # freepcb2pretty
@@ -9,7 +8,7 @@
 # This script reads a FreePCB library file and converts it to a KiCad
 # "pretty" library, primarily for generating the KiCad IPC libraries.
 
-# Tested on Python 2.7, 3.2
+# Requires Python 3.8 or newer
 
 # ROUNDED PADS EXCEPTIONS LIST:
 # This file specifies exceptions to pad-rounding; use --rounded-pad-exceptions.
@@ -44,18 +43,16 @@
 # Comments are not allowed, but blank lines are. All except mod/3dmod are
 # optional (default is scale 1/1/1, rot 0/0/0, off 0/0/0.
 
+import array
 import io
 import datetime
+import functools
+import itertools
 import time
 import sys
 import re
 import os.path
 
-try:
-    unicode
-except NameError:
-    unicode = str
-
 VERSION="1.0"
 
 TEXT_SIZE = 1.
@@ -66,6 +63,8 @@ class SexpSymbol (object):
     """An s-expression symbol. This is a bare text object which is exported
     without quotation or escaping. Be careful to use valid text here..."""
 
+    __slots__ = ("s",)
+
     def __init__ (self, s):
         self.s = s
 
@@ -75,56 +74,101 @@ class SexpSymbol (object):
     def __repr__ (self):
         return "SexpSymbol(%r)" % self.s
 
-# For short code
-S = SexpSymbol
+# Symbols are immutable, so S() hands out one shared instance per name
+SYMBOLS = {}
+
+def S (s):
+    """Return the SexpSymbol for s. (For short code)"""
+    try:
+        return SYMBOLS[s]
+    except KeyError:
+        symbol = SYMBOLS[s] = SexpSymbol (s)
+        return symbol
+
+class SexpNumber (SexpSymbol):
+    """A number already formatted as text. Its repr is that text, just as the
+    repr of the number itself would be."""
+
+    __slots__ = ()
+
+    def __repr__ (self):
+        return self.s
 
-def SexpDump (sexp, f, indentlevel=0):
-    """Dump an s-expression to a file.
-    indentlevel is used for recursion.
+# Escapes for the ASCII characters that unicode_escape would rewrite, so that
+# the common all-ASCII string can go through str.translate
+ASCII_ESCAPES = dict ((i, chr (i).encode ("unicode_escape").decode ("ascii"))
+        for i in range (128) if chr (i).encode ("unicode_escape") != chr (i).encode ("ascii"))
+
+def escape_string (s):
+    """Escape a string the way unicode_escape does."""
+    if s.isascii ():
+        return s.translate (ASCII_ESCAPES)
+    return s.encode ("unicode_escape").decode ("ascii")
+
+def SexpEmit (sexp, out):
+    """Append the text of an s-expression to the list out.
+    Nested lists are walked with a stack of iterators, not by recursion.
     """
 
-    if isinstance (sexp, list):
-        f.write ("(")
-        first = True
-        for i in sexp:
+    append = out.append
+    stack = [iter ([sexp])]
+    first = True
+    while stack:
+        for i in stack[-1]:
             if first:
                 first = False
             else:
-                f.write (" ")
+                append (" ")
 
-            SexpDump (i, f, indentlevel + 1)
-        f.write (")")
+            if isinstance (i, list):
+                append ("(")
+                stack.append (iter (i))
+                first = True
+                break
 
-    elif isinstance (sexp, (str, unicode)):
-        f.write ('"')
-        f.write (sexp.encode ("unicode_escape").decode ("ascii"))
-        f.write ('"')
+            elif isinstance (i, SexpSymbol):
+                append (i.s)
 
-    else:
-        f.write (str (sexp))
+            elif isinstance (i, str):
+                append ('"')
+                append (escape_string (i))
+                append ('"')
+
+            else:
+                append (str (i))
+
+        else:
+            # This list is done
+            stack.pop ()
+            if stack:
+                append (")")
+            first = False
+
+def SexpDump (sexp, f):
+    """Dump an s-expression to a file, in a single write."""
+    out = []
+    SexpEmit (sexp, out)
+    f.write ("".join (out))
 
 def indent_string (s):
     """Put two spaces before each line in s"""
-    lines = s.split ("\n")
-    lines = ["  " + i for i in lines]
-    lines = [("" if i == "  " else i) for i in lines]
-    return "\n".join (lines)
+    return "\n".join (("  " + i if i else "") for i in s.split ("\n"))
 
 def parse_string (s):
     """Grab a string, stripping it of quotes; return string, length."""
-    if s[0] != '"':
-        string, delim, garbage = s.partition (" ")
-        return string.strip (), len (string) + 1
+    if s[:1] != '"':
+        space = s.find (" ")
+        if space < 0:
+            return s.strip (), len (s) + 1
+        return s[:space].strip (), space + 1
 
     else:
-        try:
-            second_quote = s[1:].index ('"') + 1
-        except ValueError:
+        second_quote = s.find ('"', 1)
+        if second_quote < 0:
             return s[1:], len (s)
         else:
             beyond = s[second_quote + 1:]
-            beyond_stripped = beyond.lstrip ()
-            extra_garbage = len (beyond) - len (beyond_stripped)
+            extra_garbage = len (beyond) - len (beyond.lstrip ())
             return s[1:second_quote], second_quote + 1 + extra_garbage
 
 def to_mm (n):
@@ -134,9 +178,51 @@ def to_mm (n):
     # pretty good...
     return float(n) / 1000000.
 
+# Formatted tokens for to_mm, keyed by nanometers. The same few coordinates
+# and sizes come up over and over across a library.
+MM_TOKENS = {}
+NEG_MM_TOKENS = {}
+
+def mm_token (n):
+    """Return to_mm (n) as a preformatted token"""
+    try:
+        return MM_TOKENS[n]
+    except KeyError:
+        token = MM_TOKENS[n] = SexpNumber (repr (to_mm (n)))
+        return token
+
+def neg_mm_token (n):
+    """Return -to_mm (n) as a preformatted token. This differs from
+    mm_token (-n) at zero, where it gives -0.0."""
+    try:
+        return NEG_MM_TOKENS[n]
+    except KeyError:
+        token = NEG_MM_TOKENS[n] = SexpNumber (repr (-to_mm (n)))
+        return token
+
 def from_mm (n):
     return float(n) * 1000000.
 
+# Fixed parts of the module s-expressions, shared by every module. They must
+# not be modified.
+REF_TEXT = [S("fp_text"),
+    S("reference"), "REF**",
+    [S("at"), 0, 0],
+    [S("layer"), "F.SilkS"],
+    [S("effects"),
+        [S("font"),
+            [S("size"), 0.8, 0.8],
+            [S("thickness"), 0.15]]]]
+VALUE_TEXT_ATTRS = [
+    [S("at"), 0, 0],
+    [S("layer"), "F.Fab"],
+    [S("effects"),
+        [S("font"),
+            [S("size"), 0.5, 0.5],
+            [S("thickness"), 0.1]]]]
+SMD_LAYERS = [S("layers"), "F.Cu", "F.Paste", "F.Mask"]
+PTH_LAYERS = [S("layers"), "*.Cu", "*.Mask"]
+
 class Library (object):
     def __init__ (self, file_in=None, opts=None):
         self.Modules = []
@@ -155,10 +241,11 @@ class Library (object):
 
     def __iadd__ (self, other):
         """Add the contents of another library into this."""
-        for i in self.Modules:
-            for j in other.Modules:
-                if i.Name == j.Name:
-                    raise Exception ("Duplicate module name \"%s\"" % i.Name)
+        names = set (i.Name for i in self.Modules)
+        for i in other.Modules:
+            if i.Name in names:
+                raise Exception ("Duplicate module name \"%s\"" % i.Name)
+            names.add (i.Name)
         self.Modules.extend (other.Modules)
         self.opts = other.opts # In case it was blank
         return self
@@ -206,13 +293,21 @@ class PCBmodule (object):
         assert self.Source
         #assert self.Description
 
+        # Rounding exceptions depend only on the module name, so decide them
+        # once here rather than for every pad
+        self.CanRoundPads = not any (
+                i.match (self.Name) for i in opts.rpexceptions)
+        self.CanRoundCenter = not any (
+                i.match (self.Name) for i in opts.rcexceptions)
+
         # Post-indent data
         self.Units = None
         self.SelectionRect = None
         self.RefText = None
         self.ValText = ""
         self.Centroid = "0 0 0 0"
-        self.Graphics = []
+        self.Polylines = []
+        self.Pins = []
 
         while file_in.indent_level () and not file_in.at_end ():
             key = file_in.peek_key ()
@@ -232,11 +327,14 @@ class PCBmodule (object):
                 key, value = file_in.get_string (allow_blank=False)
                 self.Centroid = value
             elif key == "outline_polyline":
-                self.Graphics.append (Polyline.create_from_freepcb (file_in, opts))
+                self.Polylines.append (Polyline.create_from_freepcb (file_in, opts))
             elif key == "n_pins":
                 file_in.get_string (allow_blank=True) # Skip the n_pins line
             elif key == "pin":
-                self.Graphics.append (Pin.create_from_freepcb (self.Name, file_in, opts))
+                pin = Pin.create_from_freepcb (self.Name, file_in, opts)
+                pin.CanRoundPads = self.CanRoundPads
+                pin.CanRoundCenter = self.CanRoundCenter
+                self.Pins.append (pin)
             else:
                 raise Exception ("Unexpected key \"%s\" on line %d."
                         % (key, file_in.Lineno - 1))
@@ -250,6 +348,10 @@ class PCBmodule (object):
 
         self.tedit = time.time()
 
+    @property
+    def Graphics (self):
+        """All polylines, then all pins"""
+        return self.Polylines + self.Pins
 
     def __str__ (self):
         s = "PCB footprint:\n" \
@@ -257,8 +359,8 @@ class PCBmodule (object):
                 + "  Author: " + self.Author + "\n" \
                 + "  Source: " + self.Source + "\n" \
                 + "  Description: " + self.Description + "\n"
-        if self.ThreeDname is not None: \
-                s += "  3D model: " + self.ThreeDName + "\n"
+        if self.ThreeDName is not None:
+            s += "  3D model: " + self.ThreeDName + "\n"
         for i in self.Graphics:
             s += indent_string (str (i))
         return s
@@ -268,38 +370,24 @@ class PCBmodule (object):
 
         sexp.append (self.Name)
         sexp.append ([S("layer"), "F.Cu"])
-        sexp.append ([S("tedit"), "%08X" % int (self.tedit)])
+        # Kept so the caller can patch the timestamp after building this
+        self.TeditSexp = [S("tedit"), "%08X" % int (self.tedit)]
+        sexp.append (self.TeditSexp)
 
         sexp.append ([S("descr"), str(self.Description)])
 
         sexp.append ([S("attr"), S("smd")])
 
-        sexp.append ([S("fp_text"),
-            S("reference"), "REF**",
-            [S("at"), 0, 0],
-            [S("layer"), "F.SilkS"],
-            [S("effects"),
-                [S("font"),
-                    [S("size"), 0.8, 0.8],
-                    [S("thickness"), 0.15]]]])
-
-        sexp.append ([S("fp_text"),
-            S("value"), self.Name,
-            [S("at"), 0, 0],
-            [S("layer"), "F.Fab"],
-            [S("effects"),
-                [S("font"),
-                    [S("size"), 0.5, 0.5],
-                    [S("thickness"), 0.1]]]])
+        sexp.append (REF_TEXT)
+
+        sexp.append ([S("fp_text"), S("value"), self.Name] + VALUE_TEXT_ATTRS)
 
         # Polylines
-        for i in self.Graphics:
-            if not isinstance (i, Polyline): continue
+        for i in self.Polylines:
             sexp.extend (i.kicad_sexp ())
 
         # Pads/pins
-        for i in self.Graphics:
-            if not isinstance (i, Pin): continue
+        for i in self.Pins:
             sexp.extend (i.kicad_sexp ())
 
         # 3D
@@ -318,14 +406,15 @@ class PCBmodule (object):
 
     def bounding_box (self):
         """Return a (left, right, top, bottom) bounding box"""
-        sub_boxes = [i.bounding_box() for i in self.Graphics]
-        lefts = [i[0] for i in sub_boxes]
-        rights = [i[1] for i in sub_boxes]
-        tops = [i[2] for i in sub_boxes]
-        bottoms = [i[3] for i in sub_boxes]
-        
-        bb = [min(lefts), max(rights), max(tops), min(bottoms)]
-        return bb
+        boxes = itertools.chain (self.Polylines, self.Pins)
+        left, right, top, bottom = next (boxes).bounding_box ()
+        for i in boxes:
+            l, r, t, b = i.bounding_box ()
+            if l < left: left = l
+            if r > right: right = r
+            if t > top: top = t
+            if b < bottom: bottom = b
+        return [left, right, top, bottom]
 
     def add_courtyard (self, spacing):
         left, right, top, bottom = self.bounding_box ()
@@ -335,19 +424,21 @@ class PCBmodule (object):
         bottom -= from_mm (spacing)
 
         cy = Polyline ()
-        cy.Points = [(left, top), (right, top), (right, bottom), (left, bottom),
-                (left, top)]
+        # Points are whole nanometers
+        corners = [left, top, right, top, right, bottom, left, bottom, left, top]
+        cy.Points.extend (int (round (i)) for i in corners)
         cy.KicadLinewidth = 0.05
         cy.Layer = "F.CrtYd"
 
-        self.Graphics.append (cy)
+        self.Polylines.append (cy)
 
 class Polyline (object):
     def __init__ (self):
         """Read a polyline object."""
 
         self.opts = None
-        self.Points = []
+        # Flat x, y, x, y, ... in integer nanometers
+        self.Points = array.array ('i')
         self.Linewidth = None
         self.Closed = False
         self.Layer = "F.SilkS"
@@ -360,68 +451,68 @@ class Polyline (object):
         # First point and line width
         key, value = file_in.get_string (allow_blank=False)
         assert key == "outline_polyline"
-        try:
-            value = [int(i) for i in value.split ()]
-        except ValueError:
+        fields = value.split ()
+        if len (fields) != 3:
             raise Exception ("Line %d must contain a list of three integers."
                 % (file_in.Lineno - 1))
-        if len (value) != 3:
+        try:
+            width, x, y = map (int, fields)
+        except ValueError:
             raise Exception ("Line %d must contain a list of three integers."
                 % (file_in.Lineno - 1))
 
-        self.Linewidth = 0.15#value[0]
-        #print value[0]
-        self.Points.append (value[1:])
+        self.Linewidth = 0.15#width
+        #print width
+        self.Points.extend ((x, y))
 
         # Subsequent points
         while file_in.peek_key () == "next_corner":
             key, value = file_in.get_string (allow_blank=False)
             assert key == "next_corner"
-            try:
-                value = [int(i) for i in value.split ()]
-            except ValueError:
+            fields = value.split ()
+            if len (fields) != 3:
                 raise Exception ("Line %d must contain a list of three integers."
                     % (file_in.Lineno - 1))
-            if len (value) != 3:
+            try:
+                x, y, side_style = map (int, fields)
+            except ValueError:
                 raise Exception ("Line %d must contain a list of three integers."
                     % (file_in.Lineno - 1))
-            self.Points.append (value[:2])
+            self.Points.extend ((x, y))
             # Third number is "side style", which KiCad doesn't have.
 
         if file_in.peek_key () == "close_polyline":
             file_in.get_string (allow_blank=False)
             self.Closed = True
-            self.Points.append (self.Points[0])
+            self.Points.extend (self.Points[:2])
         return self
 
     def __str__ (self):
         s = "Polyline:\n" \
                 + "  Line width: " + str (self.Linewidth) + "\n"
-        for i in self.Points:
-            s += "  Point: %d, %d\n" % tuple (i)
+        points = self.Points
+        for i in range (0, len (points), 2):
+            s += "  Point: %d, %d\n" % (points[i], points[i + 1])
         return s
 
     def kicad_sexp (self):
 
         sexp = []
-        last_corner = self.Points[0]
-        for i in self.Points[1:]:
+        points = self.Points
+        for i in range (2, len (points), 2):
             sexp.append ([S("fp_line"),
-                [S("start"), to_mm (last_corner[0]), to_mm (-last_corner[1])],
-                [S("end"), to_mm (i[0]), to_mm (-i[1])],
+                [S("start"), mm_token (points[i - 2]), mm_token (-points[i - 1])],
+                [S("end"), mm_token (points[i]), mm_token (-points[i + 1])],
                 [S("layer"), self.Layer],
                 [S("width"), self.KicadLinewidth]])
-            last_corner = i
 
         return sexp
 
     def bounding_box (self):
         """Return a (left, right, top, bottom) bounding box"""
-        left = min (i[0] for i in self.Points)
-        right = max (i[0] for i in self.Points)
-        top = max (i[1] for i in self.Points)
-        bottom = min (i[1] for i in self.Points)
-        return (left, right, top, bottom) 
+        xs = self.Points[0::2]
+        ys = self.Points[1::2]
+        return (min (xs), max (xs), max (ys), min (ys))
 
 class Pin (object):
     def __init__ (self, modname):
@@ -439,6 +530,10 @@ class Pin (object):
         self.InnerPad = None
         self.BottomPad = None
 
+        # Set by the module, from the rounding exceptions lists
+        self.CanRoundPads = True
+        self.CanRoundCenter = True
+
     @classmethod
     def create_from_freepcb (cls, modname, file_in, opts):
         self = cls (modname)
@@ -448,19 +543,16 @@ class Pin (object):
         assert key == "pin"
 
         self.Name, length = parse_string (value)
-        value = value[length:]
-        try:
-            value = [int(i) for i in value.split ()]
-        except ValueError:
+        fields = value[length:].split ()
+        if len (fields) != 4:
             raise Exception ("Line %d must contain a list of four integers."
                     % (file_in.Lineno - 1))
-        if len (value) != 4:
+        try:
+            self.DrillDiam, x, y, self.Angle = map (int, fields)
+        except ValueError:
             raise Exception ("Line %d must contain a list of four integers."
                     % (file_in.Lineno - 1))
-
-        self.DrillDiam = value[0]
-        self.Coords = value[1:3]
-        self.Angle = value[3]
+        self.Coords = [x, y]
 
         while file_in.peek_key ().endswith ("_pad"):
             key, value = file_in.get_string (allow_blank=False)
@@ -499,23 +591,14 @@ class Pin (object):
                 assert self.Angle == 0
 
             # Rounded pads
-            can_round_pads = True
-            for regex in self.opts.rpexceptions:
-                if regex.match (self.ModName):
-                    can_round_pads = False
-            can_round_center = True
-            for regex in self.opts.rcexceptions:
-                if regex.match (self.ModName):
-                    can_round_center = False
-
             if self.opts.roundedpads is None:
                 shape = "rect"
-            elif not can_round_center and (0, 0) == tuple (self.Coords):
+            elif not self.CanRoundCenter and (0, 0) == tuple (self.Coords):
                 shape = "rect"
             elif self.opts.roundedpads == "all":
-                shape = "oval" if can_round_pads else "rect"
+                shape = "oval" if self.CanRoundPads else "rect"
             elif self.opts.roundedpads == "allbut1":
-                if can_round_pads:
+                if self.CanRoundPads:
                     shape = "rect" if self.Name == "1" else "oval"
                 else:
                     shape = "rect"
@@ -524,9 +607,9 @@ class Pin (object):
 
             # Output shape
             sexp = [[S("pad"), self.Name, S("smd"), S(shape),
-                [S("at"), to_mm (self.Coords[0]), -to_mm (self.Coords[1])],
-                [S("size"), to_mm (sy), to_mm (sx)],
-                [S("layers"), "F.Cu", "F.Paste", "F.Mask"]]]
+                [S("at"), mm_token (self.Coords[0]), neg_mm_token (self.Coords[1])],
+                [S("size"), mm_token (sy), mm_token (sx)],
+                SMD_LAYERS]]
 
         else:
             # PTH
@@ -541,10 +624,10 @@ class Pin (object):
                 shape = "circle"
 
             sexp = [[S("pad"), self.Name, S("thru_hole"), S(shape),
-                [S("at"), to_mm (self.Coords[0]), -to_mm (self.Coords[1])],
-                [S("size"), to_mm (sy), to_mm (sx)],
-                [S("drill"), to_mm (self.DrillDiam)],
-                [S("layers"), "*.Cu", "*.Mask"]]]
+                [S("at"), mm_token (self.Coords[0]), neg_mm_token (self.Coords[1])],
+                [S("size"), mm_token (sy), mm_token (sx)],
+                [S("drill"), mm_token (self.DrillDiam)],
+                PTH_LAYERS]]
 
         return sexp
 
@@ -588,58 +671,60 @@ class FreePCBfile (object):
     """This just wraps a FreePCB text file, reading it out in pieces."""
 
     def __init__ (self, f):
-        self.File = [i.rstrip () for i in f.readlines ()]
-        self.File.reverse ()
+        # Non-blank lines are split into (lineno, indent, key, value) as
+        # they are read. Only the next one is held, never the whole file, so
+        # f must stay open until parsing is done.
+        self.Lines = self.parse_lines (f)
+        self.Next = next (self.Lines, None)
         self.Lineno = 1
 
-    def get_string (self, allow_blank):
-        # Retrieve a line of the format "key: value"
-
-        while self.File and not self.File[-1].strip ():
-            self.File.pop ()
-            self.Lineno += 1
-
-        assert len (self.File)
-        # Gobble blank lines
-        self.Lineno += 1
-        key, delim, value = self.File.pop ().partition (":")
+    @classmethod
+    def parse_lines (cls, f):
+        for lineno, line in enumerate (f, 1):
+            line = line.rstrip ()
+            if line:
+                yield (lineno,) + cls.parse_line (line)
+
+    @staticmethod
+    def parse_line (line):
+        # Get the indentation level, two spaces = tab, and split "key: value".
+        # The line is already right-stripped.
+        indent = len (line) - len (line.lstrip (" \t"))
+        halfindents = indent + line.count ("\t", 0, indent)
+
+        key, delim, value = line.partition (":")
         key = key.strip ()
-        value = value.strip ()
+        value = value.lstrip ()
         if value.startswith ('"') and value.endswith ('"'):
             value, throwaway = parse_string (value)
+        return halfindents // 2, key, value
+
+    def get_string (self, allow_blank):
+        # Retrieve a line of the format "key: value"
+        assert self.Next is not None
+        lineno, indent, key, value = self.Next
+        self.Next = next (self.Lines, None)
+        self.Lineno = lineno + 1
         if not value:
             raise Exception ("Line %d: expected value" % (self.Lineno - 1))
 
         return key, value
 
     def indent_level (self):
-        # Get the current indentation level based on the current line, two
-        # spaces = tab.
-        line = self.File[-1]
-        i = 0
-        halfindents = 0
-        while i < len (line):
-            if line[i] == '\t':
-                halfindents += 2
-            elif line[i] == ' ':
-                halfindents += 1
-            else:
-                break
-            i += 1
-        return halfindents // 2
-    
-    def at_end (self):
-        while self.File and not self.File[-1].strip ():
-            self.File.pop ()
-            self.Lineno += 1
+        # Get the indentation level of the current line
+        if self.Next is not None:
+            return self.Next[1]
+        return 0
 
-        return not self.File
+    def at_end (self):
+        return self.Next is None
 
     def peek_key (self):
-        # Read the key from the current line without popping it
-        assert len (self.File)
-        key, delim, value = self.File[-1].partition (":")
-        return key.strip ()
+        # Read the key from the current line without consuming it. There is
+        # no key past the end.
+        if self.Next is not None:
+            return self.Next[2]
+        return ""
 
 def process_3dmap (mapfile, library):
     """Read all 3D mappings from mapfile, applying them to library."""
@@ -684,6 +769,14 @@ def process_3dmap (mapfile, library):
             raise Exception ("3D map (line %d): unknown key \"%s\"" %
                     (ff.Lineno - 1, key))
 
+@functools.lru_cache (maxsize=8)
+def load_exceptions (path, mtime):
+    """Read an exceptions file into a tuple of compiled regexes, one per line.
+    mtime is only there for the cache key: when main() is called repeatedly
+    the file is compiled once, and again only if it changes."""
+    with open (path) as f:
+        return tuple (re.compile (line.strip ()) for line in f if line.strip ())
+
 def main (args=None, zipfile=None):
     """
     When called from other Python code, 'zipfile' is accepted in lieu of a list
@@ -738,28 +831,18 @@ def main (args=None, zipfile=None):
     args = p.parse_args (args)
 
     # Parse rounded pads exceptions file?
-    rpexceptions = []
+    args.rpexceptions = ()
     if args.rpexcept is not None:
-        with open (args.rpexcept) as f:
-            for line in f:
-                line = line.strip ()
-                if not line:
-                    continue
-                rpexceptions.append (re.compile (line))
-    # It's really an argument, so put it inside args
-    args.rpexceptions = rpexceptions
+        # It's really an argument, so put it inside args
+        args.rpexceptions = load_exceptions (args.rpexcept,
+                os.path.getmtime (args.rpexcept))
 
     # Parse rounded center pads exceptions file?
-    rcexceptions = []
+    args.rcexceptions = ()
     if args.rcexcept is not None:
-        with open (args.rcexcept) as f:
-            for line in f:
-                line = line.strip ()
-                if not line:
-                    continue
-                rcexceptions.append (re.compile (line))
-    # It's really an argument, so put it inside args
-    args.rcexceptions = rcexceptions
+        # It's really an argument, so put it inside args
+        args.rcexceptions = load_exceptions (args.rcexcept,
+                os.path.getmtime (args.rcexcept))
 
     # Main conversion
     print ("Loading FreePCB library...")
@@ -792,24 +875,28 @@ def main (args=None, zipfile=None):
         for i in library.Modules:
             i.add_courtyard (args.courtyard)
 
-    # Fake timestamps?
-    if args.hashtime:
-        import hashlib
-        import struct
+    def tasks ():
+        # Fake timestamps? Each module is hashed with a zero timestamp, then
+        # the hash is patched into the same s-expression's (tedit ...) node
+        # rather than building it again.
+        if args.hashtime:
+            import hashlib
+            import struct
         for i in library.Modules:
-            i.tedit = 0
-            md5 = hashlib.md5()
-            md5.update(str(i.kicad_sexp()).encode('utf8'))
-            md5sum = md5.digest()
-            i.tedit = struct.unpack("<L", md5sum[0:4])[0]
+            if args.hashtime:
+                i.tedit = 0
+                sexp = i.kicad_sexp ()
+                md5sum = hashlib.md5 (str (sexp).encode ('utf8')).digest ()
+                i.tedit = struct.unpack ("<L", md5sum[0:4])[0]
+                i.TeditSexp[1] = "%08X" % int (i.tedit)
+            else:
+                sexp = i.kicad_sexp ()
+            yield os.path.join (args.outdir, i.Name + '.kicad_mod'), sexp
 
     print ("Generating KiCad library...")
-    for i in library.Modules:
-        path = os.path.join (args.outdir, i.Name + '.kicad_mod')
+    for path, sexp in tasks ():
         with open (path, 'w') as f:
-            sexp = i.kicad_sexp ()
             SexpDump (sexp, f)
-            # sexpdata.dump (i.kicad_sexp (), f)
 
 if __name__ == "__main__":
     main ()